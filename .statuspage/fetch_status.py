@@ -1,48 +1,234 @@
-import os, json, time, requests
-from collections import Counter
-from datetime import datetime, timezone
-from jinja2 import Template
+import os, json, time, html, argparse, logging, hashlib, string, tempfile
+import ijson, orjson
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
 BASE = "https://vx961.us1.dbt.com/api/v2"
-TOKEN = os.environ["DBT_CLOUD_TOKEN"]
-ACCOUNT = os.environ["DBT_CLOUD_ACCOUNT_ID"]
+CACHE_DIR = ".statuspage/cache"
+CACHE_MAX_AGE = 7 * 24 * 3600                   # prune entries unused for a week
+# seconds a cached latest_run answer is reused: short while a run is going,
+# longer once it has finished or when the job has no runs yet
+LATEST_RUN_TTL = {"in_progress": 10, "complete": 60, "default": 30}
+FAILED_TESTS_CAP = 100                          # shown as "100+" beyond this
+PRIORITY = {"red": 3, "amber": 2, "green": 1, "grey": 0}
+COLOR_ORDER = ("green", "amber", "red", "grey")  # order of the summary line
+SEVERITY = {"error": 3, "warn": 2, "pass": 1}   # source freshness statuses
 
-try:
-    JOB_MAP = json.loads(os.environ.get("DBT_JOB_MAP", "{}") or "{}")
-except json.JSONDecodeError:
-    JOB_MAP = {}
+log = logging.getLogger("statuspage")
 
-if JOB_MAP:
-    JOB_IDS = list(JOB_MAP.keys())
-else:
-    JOB_IDS = [j.strip() for j in os.environ["DBT_CLOUD_JOB_IDS"].split(",")]
+UMASK = os.umask(0)                             # read the umask, then restore it
+os.umask(UMASK)
 
-S = requests.Session()
-S.headers.update({"Authorization": f"Token {TOKEN}"})
+# set up by main(); module import stays free of env reads and network setup
+S = None
+ACCOUNT = None
+JOB_MAP = {}
+ARTIFACTS = None
+
+def load_jobs():
+    try:
+        job_map = json.loads(os.environ.get("DBT_JOB_MAP", "{}") or "{}")
+    except json.JSONDecodeError:
+        job_map = {}
+
+    if job_map:
+        job_ids = list(job_map.keys())
+    else:
+        job_ids = [j.strip() for j in os.environ["DBT_CLOUD_JOB_IDS"].split(",")]
+    return job_map, job_ids
+
+def make_session(token, pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Token {token}"})
+    # artifacts are large JSON and compress well; only advertise br when
+    # brotli is installed, otherwise urllib3 could not decode the body
+    try:
+        import brotli  # noqa: F401
+        session.headers["Accept-Encoding"] = "gzip, br"
+    except ImportError:
+        session.headers["Accept-Encoding"] = "gzip"
+    # keep-alive pool for the dbt Cloud host; transient errors and rate limits
+    # are retried with backoff, and the last response is handed back as-is so
+    # callers keep their own status handling
+    session.mount(BASE, HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=["GET"], raise_on_status=False),
+    ))
+    return session
+
+def write_atomic(path, data):
+    """Write bytes via a tmp file and os.replace, so readers see either the
+    old file or the new one, never a partial write."""
+    # unique tmp name per call: concurrent writers of one path (duplicate job
+    # ids, overlapping cron runs) must never share or truncate a tmp file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".")
+    try:
+        # mkstemp creates 0600; give the file the mode open() would have
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def write_json_atomic(path, data):
+    write_atomic(path, orjson.dumps(data))
+
+def status_digest(payload):
+    """Hash of a status.json payload, ignoring when it was generated."""
+    content = {k: v for k, v in payload.items() if k != "generated_at"}
+    return hashlib.sha256(orjson.dumps(content, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def previous_digest(path):
+    try:
+        with open(path, "rb") as f:
+            return status_digest(orjson.loads(f.read()))
+    except (OSError, orjson.JSONDecodeError, AttributeError):
+        return None
+
+def set_output(name, value):
+    # lets the workflow skip publishing; a no-op outside GitHub Actions
+    path = os.environ.get("GITHUB_OUTPUT")
+    if path:
+        with open(path, "a") as f:
+            f.write(f"{name}={value}\n")
+
+def cache_by_run(fn):
+    """Cache fn(run_id, name) on disk. Artifacts of a finished run never
+    change, so callers pass run_complete=True to allow a cached answer."""
+    @wraps(fn)
+    def wrapper(run_id, name, run_complete=False):
+        if not run_complete:
+            return fn(run_id, name)
+        path = os.path.join(CACHE_DIR, f"{run_id}-{fn.__name__}-{name}")
+        try:
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+            os.utime(path)                      # mark as recently used
+            return data
+        except (OSError, orjson.JSONDecodeError):
+            pass
+        data = fn(run_id, name)
+        if data is not None:
+            try:
+                write_json_atomic(path, data)
+            except OSError as exc:              # the cache is only an optimisation
+                log.warning("could not cache %s: %s", path, exc)
+        return data
+    return wrapper
+
+def prune_cache():
+    cutoff = time.time() - CACHE_MAX_AGE
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+
+def latest_run_ttl(run):
+    if run is None:
+        return LATEST_RUN_TTL["default"]
+    if run.get("is_complete") is False:
+        return LATEST_RUN_TTL["in_progress"]
+    return LATEST_RUN_TTL["complete"]
 
 def latest_run(job_id):
-    r = S.get(f"{BASE}/accounts/{ACCOUNT}/runs/",
-              params={"job_definition_id": job_id, "order_by": "-finished_at", "limit": 1},
-              timeout=30)
-    r.raise_for_status()
-    data = r.json().get("data", [])
-    return data[0] if data else None
+    """Return (run, stale). A recent cached answer is reused within its TTL;
+    if the API call fails, the last cached answer is returned as stale."""
+    import requests
 
+    path = os.path.join(CACHE_DIR, f"latest_run_{job_id}.json")
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        cached = None
+    if cached and time.time() - cached["fetched_at"] < latest_run_ttl(cached["data"]):
+        return cached["data"], False
+
+    try:
+        r = S.get(f"{BASE}/accounts/{ACCOUNT}/runs/",
+                  params={"job_definition_id": job_id, "order_by": "-finished_at", "limit": 1},
+                  timeout=30)
+        r.raise_for_status()
+    except requests.RequestException:
+        if cached:
+            return cached["data"], True
+        raise
+    data = orjson.loads(r.content).get("data", [])
+    run = data[0] if data else None
+    try:
+        write_json_atomic(path, {"fetched_at": time.time(), "data": run})
+    except OSError as exc:                      # the fresh answer still stands
+        log.warning("could not cache %s: %s", path, exc)
+    return run, False
+
+def artifact_url(run_id, name):
+    return f"{BASE}/accounts/{ACCOUNT}/runs/{run_id}/artifacts/{name}"
+
+def log_encoding(r):
+    encoding = r.headers.get("Content-Encoding")
+    if encoding in ("gzip", "br"):
+        log.debug("%s: %s-encoded", r.url, encoding)
+    else:
+        log.debug("%s: not compressed (Content-Encoding=%s)", r.url, encoding)
+
+@cache_by_run
 def get_artifact(run_id, name):
-    r = S.get(f"{BASE}/accounts/{ACCOUNT}/runs/{run_id}/artifacts/{name}", timeout=30)
-    return r.json() if r.status_code == 200 else None
+    r = S.get(artifact_url(run_id, name), timeout=30)
+    if r.status_code != 200:
+        return None
+    log_encoding(r)
+    return orjson.loads(r.content)
+
+@cache_by_run
+def count_failed_tests(run_id, name):
+    """Count failing tests in a run_results artifact, up to FAILED_TESTS_CAP.
+    The body is parsed as it streams in and reading stops at the cap, so a
+    large artifact is never held in memory whole. None if it is missing."""
+    with S.get(artifact_url(run_id, name), timeout=30, stream=True) as r:
+        if r.status_code != 200:
+            return None
+        log_encoding(r)
+        r.raw.decode_content = True             # let urllib3 undo gzip/br
+        failed = 0
+        for x in ijson.items(r.raw, "results.item"):
+            if x.get("resource_type") == "test" and x.get("status") == "fail":
+                failed += 1
+                if failed >= FAILED_TESTS_CAP:
+                    break
+        return failed
 
 def parse_status(run):
     status = run.get("status")                  # 10 success, 20 error
     in_progress = run.get("is_complete") is False
+    complete = run.get("is_complete") is True
 
-    run_results = get_artifact(run["id"], "run_results.json") or {"results": []}
-    failed_tests = sum(
-        1 for x in run_results["results"]
-        if x.get("resource_type") == "test" and x.get("status") == "fail"
-    )
+    # the artifacts only matter for a successful run, where failing tests or
+    # stale sources downgrade green to amber; skip the downloads otherwise
+    if in_progress:
+        return "amber", "run in progress", "-", "unknown", ""
+    if status == 20:
+        return "red", "last run failed", "-", "unknown", ""
+    if status != 10:
+        return "amber", f"status {status}", "-", "unknown", ""
+
+    rr_fut = ARTIFACTS.submit(count_failed_tests, run["id"], "run_results.json", run_complete=complete)
+    src_fut = ARTIFACTS.submit(get_artifact, run["id"], "sources.json", run_complete=complete)
+
+    failed_tests = rr_fut.result() or 0
+    has_failed_tests = failed_tests > 0
+    if failed_tests >= FAILED_TESTS_CAP:
+        failed_tests = f"{FAILED_TESTS_CAP}+"
 
-    sources = get_artifact(run["id"], "sources.json") or {}
+    sources = src_fut.result() or {}
     freshness = "unknown"
     freshness_detail = ""
     if "sources" in sources:
@@ -54,11 +240,19 @@ def parse_status(run):
             name = fs.get("name") or fs.get("source_name") or fs.get("unique_id") or "source"
             freshness_detail = f"{name} {fs.get('status')}"
     elif "results" in sources:
-        results = [r for r in sources["results"] if r.get("status")]
-        if results:
-            severity = {"error": 3, "warn": 2, "pass": 1}
-            worst = max(results, key=lambda r: severity.get((r.get("status") or "").lower(), 0))
-            worst_status = (worst.get("status") or "").lower()
+        # single pass: track the most severe result, first one wins on ties
+        worst, worst_sev, worst_status = None, -1, ""
+        for r in sources["results"]:
+            st = r.get("status")
+            if not st:
+                continue
+            st = st.lower()
+            sev = SEVERITY.get(st, 0)
+            if sev > worst_sev:
+                worst, worst_sev, worst_status = r, sev, st
+                if st == "error":               # nothing ranks higher
+                    break
+        if worst is not None:
             if worst_status == "error":
                 freshness = "fail"
             elif worst_status == "warn":
@@ -74,85 +268,69 @@ def parse_status(run):
             if time_ago:
                 freshness_detail += f" ({time_ago})"
 
-    color, reason = "grey", "no data"
-    if in_progress:
-        color, reason = "amber", "run in progress"
-    elif status == 10:
-        color, reason = "green", "last run success"
-        if failed_tests > 0 or freshness == "fail":
-            color = "amber"
-            reason = f"success with issues: tests={failed_tests}, freshness={freshness}"
-    elif status == 20:
-        color, reason = "red", "last run failed"
-    else:
-        color, reason = "amber", f"status {status}"
+    color, reason = "green", "last run success"
+    if has_failed_tests or freshness == "fail":
+        color = "amber"
+        reason = f"success with issues: tests={failed_tests}, freshness={freshness}"
 
     return color, reason, failed_tests, freshness, freshness_detail
 
-rows = []
-for jid in JOB_IDS:
-    run = latest_run(jid)
+# every row has these keys, in this order; the defaults describe a job
+# with no runs
+ROW_SKELETON = {
+    "job_id": None,
+    "run_id": None,
+    "job_name": None,
+    "color": "grey",
+    "reason": "no runs",
+    "failed_tests": "-",
+    "freshness": "unknown",
+    "freshness_detail": "",
+    "freshness_display": "unknown",
+    "started_at": None,
+    "finished_at": None,
+    "in_progress": False,
+    "stale": False,
+    "href": None,
+}
+
+def fetch_one(jid):
+    run, stale = latest_run(jid)
     if not run:
-        rows.append({
-            "job_id": jid,
-            "run_id": None,
-            "job_name": JOB_MAP.get(jid, jid),
-            "color": "grey",
-            "reason": "no runs",
-            "failed_tests": "-",
-            "freshness": "unknown",
-            "freshness_detail": "",
-            "freshness_display": "unknown",
-            "started_at": None,
-            "finished_at": None,
-            "in_progress": False,
-            "href": f"https://cloud.getdbt.com/#/accounts/{ACCOUNT}/jobs/{jid}"
-        })
-        continue
+        return dict(
+            ROW_SKELETON,
+            job_id=jid,
+            job_name=JOB_MAP.get(jid, jid),
+            reason="no runs (stale)" if stale else "no runs",
+            stale=stale,
+            href=f"https://cloud.getdbt.com/#/accounts/{ACCOUNT}/jobs/{jid}",
+        )
     color, reason, failed_tests, freshness, freshness_detail = parse_status(run)
+    if stale:
+        reason += " (stale)"
     job_data = run.get("job") or {}
     freshness_display = freshness
     if freshness_detail:
         freshness_display = f"{freshness}: {freshness_detail}"
-    rows.append({
-        "job_id": jid,
-        "run_id": run["id"],
-        "job_name": JOB_MAP.get(jid) or job_data.get("name") or jid,
-        "color": color,
-        "reason": reason,
-        "failed_tests": failed_tests,
-        "freshness": freshness,
-        "freshness_detail": freshness_detail,
-        "freshness_display": freshness_display,
-        "started_at": run.get("started_at"),
-        "finished_at": run.get("finished_at"),
-        "in_progress": run.get("is_complete") is False,
-        "href": f"https://cloud.getdbt.com/#/accounts/{ACCOUNT}/jobs/{jid}/runs/{run['id']}"
-    })
-
-priority = {"red": 3, "amber": 2, "green": 1, "grey": 0}
-overall = max(rows, key=lambda r: priority.get(r["color"], 0))["color"] if rows else "grey"
-color_counts = Counter(r["color"] for r in rows)
-total_jobs = len(rows)
-summary_parts = [f"{total_jobs} job{'s' if total_jobs != 1 else ''}"]
-for color in ["green", "amber", "red", "grey"]:
-    count = color_counts.get(color, 0)
-    if count:
-        summary_parts.append(f"{count} {color}")
-summary_text = " · ".join(summary_parts)
-
-os.makedirs(".statuspage/out", exist_ok=True)
-with open(".statuspage/out/status.json", "w") as f:
-    json.dump({
-        "overall": overall,
-        "generated_at": int(time.time()),
-        "total_jobs": total_jobs,
-        "counts": dict(color_counts),
-        "jobs": rows
-    }, f, indent=2)
+    return dict(
+        ROW_SKELETON,
+        job_id=jid,
+        run_id=run["id"],
+        job_name=JOB_MAP.get(jid) or job_data.get("name") or jid,
+        color=color,
+        reason=reason,
+        failed_tests=failed_tests,
+        freshness=freshness,
+        freshness_detail=freshness_detail,
+        freshness_display=freshness_display,
+        started_at=run.get("started_at"),
+        finished_at=run.get("finished_at"),
+        in_progress=run.get("is_complete") is False,
+        stale=stale,
+        href=f"https://cloud.getdbt.com/#/accounts/{ACCOUNT}/jobs/{jid}/runs/{run['id']}",
+    )
 
-html = Template("""
-<!doctype html><meta charset="utf-8"><title>dbt Status</title>
+PAGE = string.Template("""<!doctype html><meta charset="utf-8"><title>dbt Status</title>
 <style>
 body{font-family:system-ui;margin:24px}
 .pill{padding:4px 10px;border-radius:999px;color:#fff;font-weight:600}
@@ -161,29 +339,128 @@ table{border-collapse:collapse;width:100%;margin-top:16px}
 th,td{padding:8px 10px;border-bottom:1px solid #e1e4e8;text-align:left}
 a{color:inherit}
 </style>
-<h1>dbt Status <span class="pill {{overall}}">{{overall|capitalize}}</span></h1>
-<p>Updated {{updated}} UTC</p>
-<p>{{summary}}</p>
+<h1>dbt Status <span class="pill $overall">$overall_cap</span></h1>
+<p>Updated $updated UTC</p>
+<p>$summary</p>
 <table>
 <thead><tr><th>Job</th><th>Status</th><th>Reason</th><th>Tests</th><th>Freshness</th><th>Started</th><th>Finished</th></tr></thead>
 <tbody>
-{% for j in jobs %}
-<tr>
-  <td><a href="{{j.href}}" target="_blank">{{j.job_name}}</a></td>
-  <td><span class="pill {{j.color}}">{{j.color|capitalize}}</span></td>
-  <td>{{j.reason}}</td>
-  <td>{{j.failed_tests}}</td>
-  <td>{{j.freshness_display}}</td>
-  <td>{{j.started_at or "-"}}</td>
-  <td>{{j.finished_at or "-"}}</td>
+$rows</tbody></table>""")
+
+ROW = """<tr>
+  <td><a href="{href}" target="_blank">{job_name}</a></td>
+  <td><span class="pill {color}">{color_cap}</span></td>
+  <td>{reason}</td>
+  <td>{failed_tests}</td>
+  <td>{freshness_display}</td>
+  <td>{started_at}</td>
+  <td>{finished_at}</td>
 </tr>
-{% endfor %}
-</tbody></table>
-""").render(
-    overall=overall,
-    jobs=rows,
-    summary=summary_text,
-    updated=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-)
-with open(".statuspage/out/index.html", "w") as f:
-    f.write(html)
+"""
+
+def render_html(overall, jobs, summary, updated):
+    # every value is escaped here; PAGE and ROW hold only trusted markup
+    e = lambda v: html.escape(str(v))
+    rows_html = "".join(
+        ROW.format(
+            href=e(j["href"]),
+            job_name=e(j["job_name"]),
+            color=e(j["color"]),
+            color_cap=e(j["color"].capitalize()),
+            reason=e(j["reason"]),
+            failed_tests=e(j["failed_tests"]),
+            freshness_display=e(j["freshness_display"]),
+            started_at=e(j["started_at"] or "-"),
+            finished_at=e(j["finished_at"] or "-"),
+        )
+        for j in jobs
+    )
+    return PAGE.substitute(
+        overall=e(overall),
+        overall_cap=e(overall.capitalize()),
+        updated=e(updated),
+        summary=e(summary),
+        rows=rows_html,
+    )
+
+def main(argv=None):
+    global S, ACCOUNT, JOB_MAP, ARTIFACTS
+
+    parser = argparse.ArgumentParser(description="Build the dbt Cloud status page.")
+    parser.add_argument("--json-only", action="store_true",
+                        help="write status.json but skip rendering index.html")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log request details, e.g. artifact compression")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    ACCOUNT = os.environ["DBT_CLOUD_ACCOUNT_ID"]
+    JOB_MAP, job_ids = load_jobs()
+
+    # jobs are fetched in parallel, and each job fetches its two artifacts in
+    # parallel on a separate pool (sharing one pool could deadlock: job workers
+    # block on artifact futures). Size the connection pool for the peak of two
+    # requests in flight per job. The cap is high enough that a typical job
+    # list is fetched all at once rather than in batches.
+    workers = max(1, min(32, len(job_ids)))
+    ARTIFACTS = ThreadPoolExecutor(max_workers=2 * workers)
+    S = make_session(os.environ["DBT_CLOUD_TOKEN"], 2 * workers)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as ex, ARTIFACTS:
+        rows = list(ex.map(fetch_one, job_ids))
+    prune_cache()
+
+    # one pass: per-color counts and the most severe color seen
+    color_counts = {}
+    overall, overall_prio = "grey", 0
+    for r in rows:
+        c = r["color"]
+        color_counts[c] = color_counts.get(c, 0) + 1
+        p = PRIORITY.get(c, 0)
+        if p > overall_prio:
+            overall, overall_prio = c, p
+    total_jobs = len(rows)
+    summary_parts = [f"{total_jobs} job{'s' if total_jobs != 1 else ''}"]
+    for color in COLOR_ORDER:
+        count = color_counts.get(color, 0)
+        if count:
+            summary_parts.append(f"{count} {color}")
+    summary_text = " · ".join(summary_parts)
+
+    # one clock reading for both outputs, so the page and JSON agree
+    generated_at = int(time.time())
+    payload = {
+        "overall": overall,
+        "generated_at": generated_at,
+        "total_jobs": total_jobs,
+        "counts": dict(color_counts),
+        "jobs": rows
+    }
+    status_path = ".statuspage/out/status.json"
+    html_path = ".statuspage/out/index.html"
+
+    # nothing to do when the job statuses match the last output; the page
+    # only needs a rewrite if it is missing
+    changed = status_digest(payload) != previous_digest(status_path)
+    set_output("changed", str(changed).lower())
+    if not changed and (args.json_only or os.path.exists(html_path)):
+        log.info("no change since last run; outputs left as they are")
+        return
+
+    os.makedirs(".statuspage/out", exist_ok=True)
+    write_atomic(status_path, orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+
+    if args.json_only:
+        return
+
+    page = render_html(
+        overall=overall,
+        jobs=rows,
+        summary=summary_text,
+        updated=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(generated_at))
+    )
+    write_atomic(html_path, page.encode())
+
+if __name__ == "__main__":
+    main()